@@ -15,10 +15,38 @@
 # Original source code developed by Craig J. Ward and used with permission:
 # https://github.com/wardcraigj/total-connect-client
 
-import zeep
-import logging
+import os
+import gc
+import time
 import datetime
-import requests
+import resource
+import threading
+import subprocess
+
+# zeep pulls in lxml, requests and the XML schema machinery, which dominates the
+# plug-in's start time and resident memory. Both modules are imported on first
+# use by loadDependencies() rather than when Indigo loads the plug-in.
+zeep = None
+requests = None
+
+WSDL_URL = 'https://rs.alarmnet.com/TC21api/tc2.asmx?WSDL'
+
+# The only SOAP operations this client calls; the rest of the WSDL is discarded once parsed.
+USED_OPERATIONS = frozenset([
+	'AuthenticateUserLogin',
+	'GetSessionDetails',
+	'ArmSecuritySystem',
+	'DisarmSecuritySystem',
+	'GetPanelMetaDataAndFullStatus',
+	'KeepAlive',
+	'Logout',
+])
+
+# (step, seconds, RSS after the step in KB, change in RSS in KB) for each expensive start-up step, in order.
+# The RSS figures are None unless memory profiling is turned on, since reading
+# them on macOS means running ps.
+startupProfile = []
+profileMemory = False
 
 ARM_TYPE_AWAY = 0
 ARM_TYPE_STAY = 1
@@ -41,18 +69,176 @@ ARMED_STAY_NIGHT = 10218
 ARMING = 10307
 DISARMING = 10308
 
+# ResultCode returned when the session ID has expired or been invalidated
+INVALID_SESSION_CODES = (-102,)
+
+# ResultCodes from AuthenticateUserLogin meaning the user name or password was
+# refused (-50004) or the account can't log in (-100); retrying won't help
+BAD_CREDENTIALS_CODES = (-50004, -100)
+
+# How long to wait before retrying a login refused for bad credentials
+LOGIN_RETRY_DELAY = datetime.timedelta(minutes=15)
+
+class TotalConnectError(Exception):
+	"""Base class for errors when communicating with Total Connect."""
+
+	def __init__(self, message, resultCode=None):
+		Exception.__init__(self, message)
+		# Set when Total Connect answered the request with a non-Success result
+		self.resultCode = resultCode
+
+class TransportTimeoutError(TotalConnectError):
+	"""Total Connect could not be reached, or did not respond in time."""
+
+class AuthExpiredError(TotalConnectError):
+	"""The session ID is no longer valid; logging in again may succeed."""
+
+class RemoteRejectionError(TotalConnectError):
+	"""Total Connect refused the request; repeating it will not help."""
+
+class ConfigurationError(TotalConnectError):
+	"""The request cannot be made with the current configuration, so nothing was sent."""
+
+def residentMemory():
+	"""Return the current resident set size of this process in KB."""
+	try:
+		with open('/proc/self/statm') as statm:
+			return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+	except IOError:
+		# macOS has no /proc, so ask ps instead
+		return int(subprocess.check_output(['ps', '-o', 'rss=', '-p', str(os.getpid())]).strip())
+
+def setMemoryProfiling(enabled):
+	"""Turn recording of resident memory in the start-up profile on or off."""
+	global profileMemory
+	profileMemory = enabled
+
+def beginStartupStep():
+	if profileMemory:
+		return (time.time(), residentMemory())
+	return (time.time(), None)
+
+def recordStartupStep(step, begun):
+	started, rssBefore = begun
+	seconds = time.time() - started
+	if rssBefore is None:
+		startupProfile.append((step, seconds, None, None))
+	else:
+		rss = residentMemory()
+		startupProfile.append((step, seconds, rss, rss - rssBefore))
+
+def loadDependencies():
+	"""Import requests and zeep, if not already imported."""
+	global zeep, requests
+
+	if zeep is not None:
+		return
+
+	begun = beginStartupStep()
+	import requests
+	recordStartupStep('import requests', begun)
+
+	begun = beginStartupStep()
+	import zeep
+	import zeep.helpers
+	import zeep.exceptions
+	recordStartupStep('import zeep', begun)
+
+def localName(qname):
+	return getattr(qname, 'localname', str(qname).split('}')[-1])
+
+def pruneUnusedOperations(soapClient, logger):
+	"""Discard WSDL operations this client never calls, with their messages and schema elements.
+
+	This relies on zeep internals, so any part that this version of zeep doesn't
+	support is skipped with a warning. Returns the number of operations removed.
+	"""
+	wsdl = soapClient.wsdl
+	removedOperations = set()
+	zeepVersion = getattr(zeep, '__version__', 'unknown')
+
+	bindings = list(wsdl.bindings.values())
+	if not all(hasattr(binding, '_operations') for binding in bindings):
+		logger.warn('zeep %s has no operation table on WSDL bindings; unused operations were not pruned.', zeepVersion)
+		return 0
+
+	for binding in bindings:
+		operations = binding._operations
+		for name in list(operations.keys()):
+			if name not in USED_OPERATIONS:
+				del operations[name]
+				removedOperations.add(name)
+
+	# Keep only the messages still used by the remaining operations
+	usedMessages = set()
+	for portType in wsdl.port_types.values():
+		operations = getattr(portType, 'operations', {})
+		for name in list(operations.keys()):
+			if name not in USED_OPERATIONS:
+				del operations[name]
+				removedOperations.add(name)
+				continue
+			operation = operations[name]
+			usedMessages.add(id(getattr(operation, 'input_message', None)))
+			usedMessages.add(id(getattr(operation, 'output_message', None)))
+			for message in getattr(operation, 'fault_messages', {}).values():
+				usedMessages.add(id(message))
+
+	messages = getattr(wsdl, 'messages', {})
+	for qname in list(messages.keys()):
+		if id(messages[qname]) not in usedMessages:
+			del messages[qname]
+
+	# Each operation has a request and a response element in the schema, whose
+	# anonymous types are only reachable through them. Named types are kept,
+	# since responses may refer to them by name.
+	unusedElements = set()
+	for name in removedOperations:
+		unusedElements.add(name)
+		unusedElements.add(name + 'Response')
+
+	documents = list(getattr(wsdl.types, 'documents', []))
+	if not documents or not all(hasattr(document, '_elements') for document in documents):
+		logger.warn('zeep %s has no element table on schema documents; unused schema elements were not pruned.', zeepVersion)
+		documents = []
+
+	for document in documents:
+		elements = document._elements
+		for qname in list(elements.keys()):
+			if localName(qname) in unusedElements:
+				del elements[qname]
+
+	gc.collect()
+
+	return len(removedOperations)
+
+def startupProfileReport(currentMemory=False):
+	"""Return the start-up profile as a list of printable lines.
+
+	The total line includes the current resident memory if currentMemory is True.
+	"""
+	lines = ['%-28s %8s %10s %12s' % ('Step', 'Seconds', 'RSS (KB)', 'Change (KB)')]
+	total = 0
+	for step, seconds, rss, change in startupProfile:
+		total += seconds
+		if rss is None:
+			lines.append('%-28s %8.3f %10s %12s' % (step, seconds, '-', '-'))
+		else:
+			lines.append('%-28s %8.3f %10d %+12d' % (step, seconds, rss, change))
+
+	if currentMemory:
+		lines.append('%-28s %8.3f %10d' % ('Total', total, residentMemory()))
+	else:
+		lines.append('%-28s %8.3f' % ('Total', total))
+
+	return lines
+
 class TotalConnectClient:
 
 	def __init__(self, plugin, username, password):
 
-		try:
-			self.soapClient = zeep.Client('https://rs.alarmnet.com/TC21api/tc2.asmx?WSDL')
-		except requests.exceptions.ReadTimeout:
-			self.plugin.logger.error('A timeout error occurred when communicating with Total Connect. The list of available commands could not be loaded. You should restart the plug-in.')
-		except:
-			self.plugin.logger.error('An unknown error occurred when communicating with Total Connect. The list of available commands could not be loaded. You should restart the plug-in.')
-
 		self.plugin = plugin
+		self.soapClient = None
 
 		self.applicationId = "14588"
 		self.applicationVersion = "1.0.34"
@@ -60,116 +246,173 @@ class TotalConnectClient:
 		self.password = password
 		self.token = False
 		self.tokenRefresh = datetime.datetime.min
+		self.loginRejected = datetime.datetime.min
+		self.sessionLock = threading.RLock()
 
 		self.locations = []
+		self.locationsLoaded = False
 
-		self.authenticate()
+	def loadSoapClient(self):
+		"""Import zeep and parse the Total Connect WSDL on first use."""
+		if self.soapClient is not None:
+			return
+
+		loadDependencies()
+
+		try:
+			begun = beginStartupStep()
+			soapClient = zeep.Client(WSDL_URL)
+			recordStartupStep('parse WSDL', begun)
+		except requests.exceptions.RequestException as e:
+			raise TransportTimeoutError('The list of available commands could not be loaded: %s' % e)
+		except zeep.exceptions.Error as e:
+			raise RemoteRejectionError('The list of available commands could not be loaded: %s' % e)
+
+		begun = beginStartupStep()
+		removed = pruneUnusedOperations(soapClient, self.plugin.logger)
+		recordStartupStep('prune %d operations' % removed, begun)
+
+		self.soapClient = soapClient
+		for line in startupProfileReport():
+			self.plugin.logger.debug(line)
+
+	def call(self, operation, *args):
+		"""Invoke a SOAP operation, raising a TotalConnectError unless it reports success."""
+		self.loadSoapClient()
+
+		try:
+			response = getattr(self.soapClient.service, operation)(*args)
+		except requests.exceptions.Timeout:
+			raise TransportTimeoutError('A timeout error occurred when communicating with Total Connect.')
+		except requests.exceptions.RequestException as e:
+			raise TransportTimeoutError('Could not connect to Total Connect: %s' % e)
+		except zeep.exceptions.TransportError as e:
+			raise TransportTimeoutError('Total Connect returned HTTP status %s.' % e.status_code)
+		except zeep.exceptions.Error as e:
+			raise RemoteRejectionError('Total Connect could not process %s: %s' % (operation, e))
+
+		if response.ResultData != 'Success':
+			if (response.ResultCode in INVALID_SESSION_CODES) or ('session' in str(response.ResultData).lower()):
+				raise AuthExpiredError('%s (%s)' % (response.ResultData, response.ResultCode), response.ResultCode)
+			raise RemoteRejectionError('%s (%s)' % (response.ResultData, response.ResultCode), response.ResultCode)
+
+		self.recordSuccessfulCommand()
+		return response
+
+	def callWithSession(self, operation, *args):
+		"""Invoke an operation that takes the session ID, logging in again once if the session has expired."""
+		with self.sessionLock:
+			self.prepareConnection()
+			token = self.token
+
+		try:
+			return self.call(operation, token, *args)
+		except AuthExpiredError:
+			token = self.reestablishSession(token)
+			return self.call(operation, token, *args)
 
 	def authenticate(self):
 		"""Login to the system."""
-		try:
-			response = self.soapClient.service.AuthenticateUserLogin(self.username, self.password, self.applicationId, self.applicationVersion)
-			if response.ResultData == 'Success':
-				self.token = response.SessionID
-				self.recordSuccessfulCommand()
-				self.plugin.logger.info('Logged in to Total Connect as user: %s', self.username)
-			else:
-				self.plugin.logger.error('Authentication error when connecting to Total Connect: %s', response.ResultData)
-		except requests.exceptions.ReadTimeout:
-			self.plugin.logger.error('A timeout error occurred when communicating with Total Connect. Authentication failed.')
-		except:
-			self.plugin.logger.error('An unknown error occurred when communicating with Total Connect. Authentication failed.')
+		with self.sessionLock:
+			self.loadSoapClient()
 
-	def populate_details(self, isRetry=False):
+			# The current session ID stays in place until a new one arrives
+			try:
+				response = self.call('AuthenticateUserLogin', self.username, self.password, self.applicationId, self.applicationVersion)
+			except (AuthExpiredError, RemoteRejectionError) as e:
+				if e.resultCode is None:
+					# A fault or unreadable reply, not a refused login
+					raise
+				self.token = False
+				if e.resultCode in BAD_CREDENTIALS_CODES:
+					# Only bad credentials stop further logins; other refusals are left to the poll back-off
+					self.loginRejected = datetime.datetime.now()
+				raise RemoteRejectionError('Authentication error when connecting to Total Connect: %s' % e, e.resultCode)
+
+			self.token = response.SessionID
+			self.loginRejected = datetime.datetime.min
+			self.plugin.logger.info('Logged in to Total Connect as user: %s', self.username)
+
+	def setCredentials(self, username, password):
+		"""Use a new user name and password for future logins."""
+		with self.sessionLock:
+			self.logout()
+			self.username = username
+			self.password = password
+			self.loginRejected = datetime.datetime.min
+
+			# The new account may have different locations
+			self.locations = []
+			self.locationsLoaded = False
+
+	def populate_details(self):
 		"""Populates system details."""
-
-		self.prepareConnection()
 		try:
-			response = self.soapClient.service.GetSessionDetails(self.token, self.applicationId, self.applicationVersion)
+			self.load_locations()
+		except TotalConnectError as e:
+			self.plugin.logger.error('Configuration details could not be loaded from Total Connect. They will be loaded again when next needed. %s', e)
+			return False
 
-			if (isRetry == False) and (response.ResultData != 'Success'):
-				self.reestablishSession()
-				self.populate_details(isRetry=True)
-			else:
-				if response.ResultData == 'Success':
-					self.recordSuccessfulCommand()
+		return True
 
-					self.plugin.logger.debug('Fetched session details from Total Connect.')
+	def load_locations(self):
+		"""Fetch the locations for this account, raising a TotalConnectError on failure."""
+		response = self.callWithSession('GetSessionDetails', self.applicationId, self.applicationVersion)
 
-					self.locations = zeep.helpers.serialize_object(response.Locations)['LocationInfoBasic']
+		self.plugin.logger.debug('Fetched session details from Total Connect.')
 
-					self.plugin.logger.debug('Fetched configuration details from Total Connect.')
-				
-					return True
-				else:
-					self.plugin.logger.error('Failed to fetch configuration details from Total Connect: %s', response.ResultData)
-					return False
+		self.locations = zeep.helpers.serialize_object(response.Locations)['LocationInfoBasic']
+		self.locationsLoaded = True
 
-		except requests.exceptions.ReadTimeout:
-			self.plugin.logger.error('A timeout error occurred when communicating with Total Connect. Configuration details could not be loaded. You may need to restart the plug-in.')
-		except:
-			self.plugin.logger.error('An unknown error occurred when communicating with Total Connect. Configuration details could not be loaded. You may need to restart the plug-in.')
+		self.plugin.logger.debug('Fetched configuration details from Total Connect.')
 				
 	def executeRunLoopTasks(self):
 		# Send keepAlive command at intervals to ensure connection stays active
 		timeSinceRefresh = datetime.datetime.now() - self.tokenRefresh
 		
     	#return false if time since refresh is over 4 minutes (likely timeout)       
-		if timeSinceRefresh.total_seconds() > 3 * 60:
+		if (self.token != False) and (timeSinceRefresh.total_seconds() > 3 * 60):
 			self.keepAlive()
 		
 
 	def arm_away(self, location_name=False):
 		"""Arm the system (Away)."""
 
-		self.arm(ARM_TYPE_AWAY, location_name)
+		return self.arm(ARM_TYPE_AWAY, location_name)
 
 	def arm_stay(self, location_name=False):
 		"""Arm the system (Stay)."""
 
-		self.arm(ARM_TYPE_STAY, location_name)
+		return self.arm(ARM_TYPE_STAY, location_name)
 
 	def arm_stay_instant(self, location_name=False):
 		"""Arm the system (Stay - Instant)."""
 
-		self.arm(ARM_TYPE_STAY_INSTANT, location_name)
+		return self.arm(ARM_TYPE_STAY_INSTANT, location_name)
 
 	def arm_away_instant(self, location_name=False):
 		"""Arm the system (Away - Instant)."""
 
-		self.arm(ARM_TYPE_AWAY_INSTANT, location_name)
+		return self.arm(ARM_TYPE_AWAY_INSTANT, location_name)
 
 	def arm_stay_night(self, location_name=False):
 		"""Arm the system (Stay - Night)."""
 
-		self.arm(ARM_TYPE_STAY_NIGHT, location_name)
+		return self.arm(ARM_TYPE_STAY_NIGHT, location_name)
 
-	def arm(self, arm_type, location_name=False, isRetry=False):
+	def arm(self, arm_type, location_name=False):
 		"""Arm the system."""
-
-		location = self.get_location_by_location_name(location_name)
-		deviceId = self.get_security_panel_device_id(location)
-
-		self.prepareConnection()
 		try:
-			response = self.soapClient.service.ArmSecuritySystem(self.token, location['LocationID'], deviceId, arm_type, '-1')
-
-			if (isRetry == False) and (response.ResultData != 'Success'):
-				self.reestablishSession()
-				self.arm(arm_type, location_name, True)
-			else:
-				if response.ResultData == 'Success':
-					self.recordSuccessfulCommand()
-					self.plugin.logger.debug('Armed security panel (arm type=%d) at %s location via Total Connect.', arm_type, location_name)
+			location = self.get_location_by_location_name(location_name)
+			deviceId = self.get_security_panel_device_id(location)
 
-				else:
-					self.plugin.logger.warn('Failed to arm security panel (arm type=%d) at %s location via Total Connect: %s', arm_type, location_name, response.ResultData)
-
-		except requests.exceptions.ReadTimeout:
-			self.plugin.logger.warn('A timeout error occurred when communicating with Total Connect. The security panel may not be armed.')
-		except:
-			self.plugin.logger.warn('An unknown error occurred when communicating with Total Connect. The security panel may not be armed.')
+			self.callWithSession('ArmSecuritySystem', location['LocationID'], deviceId, arm_type, '-1')
+		except TotalConnectError as e:
+			self.plugin.logger.warn('Failed to arm security panel (arm type=%d) at %s location via Total Connect. The security panel may not be armed. %s', arm_type, location_name, e)
+			return False
 
+		self.plugin.logger.debug('Armed security panel (arm type=%d) at %s location via Total Connect.', arm_type, location_name)
+		return True
 
 	def get_security_panel_device_id(self, location):
 		"""Find the device id of the security panel."""
@@ -179,13 +422,17 @@ class TotalConnectClient:
 				deviceId = device['DeviceID']
 
 		if deviceId is False:
-			raise Exception('No security panel found')
+			raise ConfigurationError('No security panel found at %s location.' % location['LocationName'])
 
 		return deviceId
 
 	def get_location_by_location_name(self, location_name=False):
 		"""Get the location object for a given name (or the default location if none is provided)."""
 
+		# A location can only be reported missing once the list has actually been loaded
+		if not self.locationsLoaded:
+			self.load_locations()
+
 		location = False
 
 		for loc in self.locations:
@@ -195,37 +442,31 @@ class TotalConnectClient:
 				location = loc
 
 		if location is False:
-			raise Exception('Could not select location. Try using default location.')
+			raise ConfigurationError('Could not select location %s. Try using default location.' % location_name)
 
 		return location
 
-	def get_armed_status(self, location_name=False, isRetry=False):
-		"""Get the status of the panel."""
+	def fetch_armed_status(self, location_name=False):
+		"""Get the status of the panel, raising a TotalConnectError on failure."""
 		location = self.get_location_by_location_name(location_name)
 
-		self.prepareConnection()
-		try:
-			response = self.soapClient.service.GetPanelMetaDataAndFullStatus(self.token, location['LocationID'], 0, 0, 1)
+		response = self.callWithSession('GetPanelMetaDataAndFullStatus', location['LocationID'], 0, 0, 1)
 
-			if (isRetry == False) and (response.ResultData != 'Success'):
-				self.reestablishSession()
-				self.get_armed_status(location_name, True)
-			else:
-				if response.ResultData == 'Success':
-					self.recordSuccessfulCommand()
-					status = zeep.helpers.serialize_object(response)
-					alarm_code = status['PanelMetadataAndStatus']['Partitions']['PartitionInfo'][0]['ArmingState']
-					self.plugin.logger.debug('Retrieved armed status of %s location: %d', location_name, alarm_code)
+		status = zeep.helpers.serialize_object(response)
+		try:
+			alarm_code = status['PanelMetadataAndStatus']['Partitions']['PartitionInfo'][0]['ArmingState']
+		except (KeyError, IndexError, TypeError):
+			raise RemoteRejectionError('Total Connect returned a panel status for %s location without any partitions.' % location_name)
+		self.plugin.logger.debug('Retrieved armed status of %s location: %d', location_name, alarm_code)
 
-				else:
-					self.plugin.logger.warn('Could not obtain armed status of location %s.', location_name)
-					alarm_code = ERROR
+		return alarm_code
 
-			return alarm_code
-		except requests.exceptions.ReadTimeout:
-			self.plugin.logger.warn('A timeout error occurred when communicating with Total Connect. The current status could not be read.')
-		except:
-			self.plugin.logger.warn('An unknown error occurred when communicating with Total Connect. The current status could not be read.')
+	def get_armed_status(self, location_name=False):
+		"""Get the status of the panel."""
+		try:
+			return self.fetch_armed_status(location_name)
+		except TotalConnectError as e:
+			self.plugin.logger.warn('Could not obtain armed status of location %s. %s', location_name, e)
 
 		return ERROR
 
@@ -293,48 +534,84 @@ class TotalConnectClient:
 		else:
 			return False
 
-	def disarm(self, location_name=False, isRetry=False):
+	def disarm(self, location_name=False):
 		"""Disarm the system."""
+		try:
+			location = self.get_location_by_location_name(location_name)
+			deviceId = self.get_security_panel_device_id(location)
 
-		location = self.get_location_by_location_name(location_name)
-		deviceId = self.get_security_panel_device_id(location)
+			self.plugin.logger.debug('Device ID %s found for location %s.', deviceId, location_name)
 
-		self.plugin.logger.debug('Device ID %s found for location %s.', deviceId, location_name)
+			self.callWithSession('DisarmSecuritySystem', location['LocationID'], deviceId, '-1')
+		except TotalConnectError as e:
+			self.plugin.logger.warn('Failed to disarm security panel at %s location via Total Connect. The security panel may not be disarmed. %s', location_name, e)
+			return False
 
-		self.prepareConnection()
-		try:
-			response = self.soapClient.service.DisarmSecuritySystem(self.token, location['LocationID'], deviceId, '-1')
-		
-			if (isRetry == False) and (response.ResultData != 'Success'):
-				self.reestablishSession()
-				self.disarm(location_name, True)
-			else:
-				if response.ResultData == 'Success':
-					self.recordSuccessfulCommand()
-					self.plugin.logger.debug('Disarmed security panel at %s location via Total Connect.', location_name)
+		self.plugin.logger.debug('Disarmed security panel at %s location via Total Connect.', location_name)
+		return True
+
+	def execute_batch(self, commands):
+		"""Arm or disarm several locations at once.
 
+		commands maps each location name to an arm type, or to None to disarm
+		that location. The commands are dispatched concurrently over the current
+		session, and each location's armed status is read back afterwards.
+		Returns a dict mapping each location name to a (success, armed status)
+		tuple, where the status is None if it could not be read.
+		"""
+		results = dict((location_name, (False, None)) for location_name in commands)
+
+		def dispatch(location_name, arm_type):
+			try:
+				if arm_type is None:
+					success = self.disarm(location_name)
 				else:
-					self.plugin.logger.warn('Failed to disarm security panel at %s location via Total Connect: %s', location_name, response.ResultData)
-		except requests.exceptions.ReadTimeout:
-			self.plugin.logger.warn('A timeout error occurred when communicating with Total Connect. The security panel may not be disarmed.')
-		except:
-			self.plugin.logger.warn('An unknown error occurred when communicating with Total Connect. The security panel may not be disarmed.')
+					success = self.arm(arm_type, location_name)
+
+				try:
+					alarm_code = self.fetch_armed_status(location_name)
+				except TotalConnectError as e:
+					self.plugin.logger.warn('Could not obtain armed status of location %s. %s', location_name, e)
+					alarm_code = None
+
+				results[location_name] = (success, alarm_code)
+			except Exception:
+				# Exceptions in a thread would otherwise only reach stderr, not the Indigo log
+				self.plugin.logger.exception('Unexpected error sending command to %s location.', location_name)
+
+		# Log in and load the locations once up front, so the threads share a
+		# single session and don't each fetch the locations
+		try:
+			self.prepareConnection()
+			if not self.locationsLoaded:
+				self.load_locations()
+		except TotalConnectError as e:
+			self.plugin.logger.warn('Could not connect to Total Connect; no commands were sent. %s', e)
+			return results
+
+		threads = []
+		for location_name, arm_type in commands.items():
+			thread = threading.Thread(target=dispatch, args=(location_name, arm_type))
+			thread.start()
+			threads.append(thread)
+
+		for thread in threads:
+			thread.join()
+
+		return results
 
 	def logout(self):
 		"""Request that the given sessionID be logged out and/or terminated."""
 		if self.token != False:
 			try:
-				response = self.soapClient.service.Logout(self.token)
-				if response.ResultData == 'Success':
-					self.token = False	
-					self.tokenRefresh = datetime.datetime.min
-					self.plugin.logger.info("Logged out of Total Connect.")			
-				else:
-					self.plugin.logger.warn('Error logging out of Total Connect: %s.', response.ResultData)
-			except requests.exceptions.ReadTimeout:
-				self.plugin.logger.warn('A timeout error occurred when communicating with Total Connect. Error when logging out.')
-			except:
-				self.plugin.logger.warn('An unknown error occurred when communicating with Total Connect. Error when logging out.')
+				self.call('Logout', self.token)
+			except TotalConnectError as e:
+				self.plugin.logger.warn('Error logging out of Total Connect: %s', e)
+			else:
+				self.plugin.logger.info("Logged out of Total Connect.")
+
+			self.token = False
+			self.tokenRefresh = datetime.datetime.min
 			
 	def tokenIsValid(self):
 		if self.token == False:
@@ -352,27 +629,36 @@ class TotalConnectClient:
 		return self.locations
 		
 	def prepareConnection(self):
-		if not self.tokenIsValid():
-			self.authenticate()
+		with self.sessionLock:
+			if not self.tokenIsValid():
+				# Don't repeat a login that was just refused; it will be refused again
+				if datetime.datetime.now() - self.loginRejected < LOGIN_RETRY_DELAY:
+					raise RemoteRejectionError('Total Connect recently rejected the login for user %s. Check the user name and password in the plug-in configuration.' % self.username)
+				self.authenticate()
 			
 	def recordSuccessfulCommand(self):
 		self.tokenRefresh = datetime.datetime.now()
 			
 	def keepAlive(self):
 		try:
-			response = self.soapClient.service.KeepAlive(self.token)
-			if response.ResultData == 'Success':
-				self.plugin.logger.debug('Keep alive used to maintain connection to Total Connect.')
-				self.recordSuccessfulCommand()
-		except requests.exceptions.ReadTimeout:
-			self.plugin.logger.warn('A timeout error occurred when communicating with Total Connect. The connection could not be kept open.')
-		except:
-			self.plugin.logger.warn('An unknown error occurred when communicating with Total Connect. The connection could not be kept open.')
-
-			
-	def reestablishSession(self):
-		self.plugin.logger.info("Last command failed due to invalid Total Connect session ID. Logging in again.")
-		self.authenticate()
+			self.call('KeepAlive', self.token)
+			self.plugin.logger.debug('Keep alive used to maintain connection to Total Connect.')
+		except AuthExpiredError:
+			# Log in again on the next command rather than sending it with a dead session
+			self.plugin.logger.debug('Total Connect session expired; logging in again on the next command.')
+			self.token = False
+		except TotalConnectError as e:
+			self.plugin.logger.warn('The connection to Total Connect could not be kept open. %s', e)
+
+	def reestablishSession(self, failedToken):
+		"""Log in again after failedToken was rejected, returning the session ID to retry with."""
+		with self.sessionLock:
+			# Another thread may already have logged in again while this one waited
+			if self.token == failedToken:
+				self.plugin.logger.info("Last command failed due to invalid Total Connect session ID. Logging in again.")
+				self.authenticate()
+
+			return self.token
 			
 	def armedStatusDetailString(self, armed_status=False):
 		if armed_status == DISARMED:
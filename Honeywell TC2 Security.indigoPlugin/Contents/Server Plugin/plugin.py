@@ -15,9 +15,28 @@
 import sys
 import datetime
 
-from Honeywell import TotalConnectClient
+from Honeywell import TotalConnectClient, startupProfileReport, setMemoryProfiling
+from Honeywell import TotalConnectError, ConfigurationError
+from Honeywell import ARM_TYPE_AWAY, ARM_TYPE_STAY, ARM_TYPE_STAY_INSTANT, ARM_TYPE_AWAY_INSTANT, ARM_TYPE_STAY_NIGHT
 
-ERROR = -1
+# Arm modes offered by the Arm/Disarm Locations action; None disarms
+BULK_ARM_MODES = {
+	'disarm': (None, u'Disarm'),
+	'armStay': (ARM_TYPE_STAY, u'Arm Stay'),
+	'armAway': (ARM_TYPE_AWAY, u'Arm Away'),
+	'armStayInstant': (ARM_TYPE_STAY_INSTANT, u'Arm Stay Instant'),
+	'armAwayInstant': (ARM_TYPE_AWAY_INSTANT, u'Arm Away Instant'),
+	'armStayNight': (ARM_TYPE_STAY_NIGHT, u'Arm Night Stay'),
+}
+
+# Keypad poll setting meaning "use the plug-in's Frequency of Status Update"
+USE_PLUGIN_REFRESH_INTERVAL = -1
+
+# lastStatusUpdate of a keypad whose status hasn't been read since it started
+NEVER_UPDATED = '2000-01-01 00:00:00'
+
+# Minutes between attempts to read the initial status of a keypad set to No refresh
+INITIAL_STATUS_RETRY_INTERVAL = 5
 
 
 class Plugin(indigo.PluginBase):
@@ -29,17 +48,28 @@ class Plugin(indigo.PluginBase):
 		self.tcPassword = pluginPrefs.get("password", '')
 		
 		self.refreshInterval = int(pluginPrefs.get("refreshInterval", 0))
+
+		setMemoryProfiling(pluginPrefs.get("profileMemory", False))
 		
 		self.Honeywell = None
+		self.locationNames = []
+
+		# Keypads whose location can't be polled until they are reconfigured
+		self.misconfiguredKeypads = set()
+
+		# Time of the last failed status update of each keypad, so it waits its normal interval before retrying
+		self.failedStatusUpdates = {}
 				
 	def __del__(self):
 		indigo.PluginBase.__del__(self)
 		
 	def startup(self):
 		self.logger.debug(u"Startup called")
+		# Nothing is fetched from Total Connect here, so that zeep is only imported and
+		# the WSDL parsed once the run loop or a dialog first needs them
 		self.Honeywell = TotalConnectClient(self, self.tcUsername, self.tcPassword)
-		fetchedDetails = self.Honeywell.populate_details()
-		
+
+	def loadLocationNames(self):
 		# Retrieve Locations
 		
 		locationList = self.Honeywell.get_locations()
@@ -65,15 +95,29 @@ class Plugin(indigo.PluginBase):
 
 				timeSinceRefresh = datetime.timedelta.max
 
-				if self.refreshInterval > 0:
-					for keypad in indigo.devices.iter("self.alarmKeypad"):				
-						lastStatusUpdate = datetime.datetime.strptime(keypad.states['lastStatusUpdate'], '%Y-%m-%d %H:%M:%S')
-						timeSinceRefresh = datetime.datetime.now() - lastStatusUpdate
-		
-						#return false if time since refresh is over 4 minutes (likely timeout)       
-						if (timeSinceRefresh.total_seconds() > self.refreshInterval * 60) or (keypad.states['state'] == 'Arming') or (keypad.states['state'] == 'Disarming'):
-							self.logger.debug('Updating status of %s.', keypad.name)
-							self.updateDeviceStatus(keypad)
+				for keypad in indigo.devices.iter("self.alarmKeypad"):				
+					if keypad.id in self.misconfiguredKeypads:
+						continue
+
+					now = datetime.datetime.now()
+					refreshInterval = self.keypadRefreshInterval(keypad, now)
+
+					neverUpdated = (keypad.states['lastStatusUpdate'] == NEVER_UPDATED)
+					if neverUpdated and (refreshInterval == 0):
+						# Keypads set to No refresh still need their initial status
+						refreshInterval = INITIAL_STATUS_RETRY_INTERVAL
+
+					lastStatusUpdate = datetime.datetime.strptime(keypad.states['lastStatusUpdate'], '%Y-%m-%d %H:%M:%S')
+					lastStatusUpdate = max(lastStatusUpdate, self.failedStatusUpdates.get(keypad.id, datetime.datetime.min))
+					timeSinceRefresh = now - lastStatusUpdate
+
+					# Keypads that are arming or disarming are checked on every pass, unless the last check
+					# failed or the keypad is never refreshed, whether armed or not
+					isTransitioning = (keypad.states['state'] == 'Arming') or (keypad.states['state'] == 'Disarming')
+					if ((refreshInterval > 0) and (timeSinceRefresh.total_seconds() > refreshInterval * 60)) or (isTransitioning and self.keypadPollsTransitions(keypad) and (keypad.id not in self.failedStatusUpdates)):
+						self.logger.debug('Updating status of %s.', keypad.name)
+						# Don't fire triggers on initial status setting
+						self.updateDeviceStatus(keypad, triggerEvents=not neverUpdated)
 								
 				
 				self.sleep(30) # in seconds
@@ -86,37 +130,91 @@ class Plugin(indigo.PluginBase):
 	# Device specific methods
 	########################################################
 	def deviceStartComm(self, dev):
-		dev.updateStateOnServer('lastStatusUpdate', value='2000-01-01 00:00:00', triggerEvents=False)
-
-		# Update status, but don't fire triggers on initial status setting
-		self.updateDeviceStatus(dev, triggerEvents=False)
+		self.misconfiguredKeypads.discard(dev.id)
+		self.failedStatusUpdates.pop(dev.id, None)
+		# The run loop reads the initial status on its next pass
+		dev.updateStateOnServer('lastStatusUpdate', value=NEVER_UPDATED, triggerEvents=False)
 			
+	def keypadRefreshInterval(self, keypad, now):
+		"""Return the minutes allowed between status updates of a keypad at the given time, or 0 for none."""
+		props = keypad.pluginProps
+		refreshInterval = self.keypadDefaultRefreshInterval(keypad)
+
+		if keypad.states['isArmed']:
+			refreshInterval = self.keypadArmedRefreshInterval(keypad)
+		elif props.get('quietHoursEnabled', False) and self.inQuietHours(props, now.hour):
+			refreshInterval = int(props.get('quietRefreshInterval', 60))
+
+		return refreshInterval
+
+	def keypadDefaultRefreshInterval(self, keypad):
+		"""Return the keypad's refresh interval in minutes outside the armed and quiet-hours profiles."""
+		refreshInterval = int(keypad.pluginProps.get('refreshInterval', USE_PLUGIN_REFRESH_INTERVAL))
+		if refreshInterval == USE_PLUGIN_REFRESH_INTERVAL:
+			refreshInterval = self.refreshInterval
+
+		return refreshInterval
+
+	def keypadArmedRefreshInterval(self, keypad):
+		"""Return the keypad's refresh interval in minutes while armed."""
+		armedRefreshInterval = int(keypad.pluginProps.get('armedRefreshInterval', USE_PLUGIN_REFRESH_INTERVAL))
+		if armedRefreshInterval == USE_PLUGIN_REFRESH_INTERVAL:
+			return self.keypadDefaultRefreshInterval(keypad)
+
+		return armedRefreshInterval
+
+	def keypadPollsTransitions(self, keypad):
+		"""Return True if the keypad should be checked on every pass while arming or disarming."""
+		return (self.keypadDefaultRefreshInterval(keypad) > 0) or (self.keypadArmedRefreshInterval(keypad) > 0)
+
+	def inQuietHours(self, props, hour):
+		start = int(props.get('quietHoursStart', 23))
+		end = int(props.get('quietHoursEnd', 6))
+
+		if start <= end:
+			return start <= hour < end
+		else:
+			# Quiet hours span midnight
+			return hour >= start or hour < end
+
 	def updateDeviceStatus(self, dev, triggerEvents=True):
-		armedStatus = self.Honeywell.get_armed_status(dev.pluginProps['locationName'])
-		if armedStatus != ERROR:
-			armedStatusDetailString = self.Honeywell.armedStatusDetailString(armedStatus)
-			armedStatusTypeString = self.Honeywell.armedStatusTypeString(armedStatus)
-			isArmed = self.Honeywell.isArmed(armedStatus)
-			isBypass = self.Honeywell.isBypass(armedStatus)
-			armedStatusDetailStringDisplayValue = self.Honeywell.armedStatusDetailStringDisplayValue(armedStatus)
-			armedStatusTypeStringDisplayValue = self.Honeywell.armedStatusTypeStringDisplayValue(armedStatus)
-
-			if (triggerEvents == False) or (armedStatusTypeString != dev.states['state']):
-				self.logger.info('%s is %s; status last updated at %s', dev.name, armedStatusDetailStringDisplayValue, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-			else:
-				self.logger.debug('%s is %s; status last updated at %s', dev.name, armedStatusDetailStringDisplayValue, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-			dev.updateStateOnServer('state', value=armedStatusTypeString, uiValue=armedStatusTypeStringDisplayValue, triggerEvents=triggerEvents)
-			dev.updateStateOnServer('isBypass', value=isBypass, triggerEvents=triggerEvents)
-			dev.updateStateOnServer('isArmed', value=isArmed, triggerEvents=triggerEvents)
-			dev.updateStateOnServer('lastStatusUpdate', value=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), triggerEvents=False)
-			if isArmed:
-				dev.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
-			else:
-				dev.updateStateImageOnServer(indigo.kStateImageSel.SensorOn)
-			
-			return True
+		try:
+			armedStatus = self.Honeywell.fetch_armed_status(dev.pluginProps['locationName'])
+		except ConfigurationError as e:
+			# Polling again won't help until the keypad is reconfigured
+			self.misconfiguredKeypads.add(dev.id)
+			self.logger.error(u'%s cannot be updated: %s', dev.name, e)
+			return False
+		except TotalConnectError as e:
+			self.failedStatusUpdates[dev.id] = datetime.datetime.now()
+			self.logger.warn(u'Could not obtain armed status of %s. %s', dev.name, e)
+			return False
+
+		self.applyDeviceStatus(dev, armedStatus, triggerEvents)
+		return True
+
+	def applyDeviceStatus(self, dev, armedStatus, triggerEvents=True):
+		self.failedStatusUpdates.pop(dev.id, None)
+
+		armedStatusDetailString = self.Honeywell.armedStatusDetailString(armedStatus)
+		armedStatusTypeString = self.Honeywell.armedStatusTypeString(armedStatus)
+		isArmed = self.Honeywell.isArmed(armedStatus)
+		isBypass = self.Honeywell.isBypass(armedStatus)
+		armedStatusDetailStringDisplayValue = self.Honeywell.armedStatusDetailStringDisplayValue(armedStatus)
+		armedStatusTypeStringDisplayValue = self.Honeywell.armedStatusTypeStringDisplayValue(armedStatus)
+
+		if (triggerEvents == False) or (armedStatusTypeString != dev.states['state']):
+			self.logger.info('%s is %s; status last updated at %s', dev.name, armedStatusDetailStringDisplayValue, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+		else:
+			self.logger.debug('%s is %s; status last updated at %s', dev.name, armedStatusDetailStringDisplayValue, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+		dev.updateStateOnServer('state', value=armedStatusTypeString, uiValue=armedStatusTypeStringDisplayValue, triggerEvents=triggerEvents)
+		dev.updateStateOnServer('isBypass', value=isBypass, triggerEvents=triggerEvents)
+		dev.updateStateOnServer('isArmed', value=isArmed, triggerEvents=triggerEvents)
+		dev.updateStateOnServer('lastStatusUpdate', value=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), triggerEvents=False)
+		if isArmed:
+			dev.updateStateImageOnServer(indigo.kStateImageSel.SensorTripped)
 		else:
-			return False	
+			dev.updateStateImageOnServer(indigo.kStateImageSel.SensorOn)
 	
 	########################################################
 	# Action object callback methods
@@ -148,21 +246,88 @@ class Plugin(indigo.PluginBase):
 		locationName = keypadDevice.pluginProps['locationName']
 		self.Honeywell.arm_stay_night(locationName)
 		self.updateDeviceStatus(dev)
+
+	def armStayInstant(self, action, dev):
+		keypadDevice = dev
+		self.logger.info(u"Security panel %s stay arming (instant).", keypadDevice.name)
+		locationName = keypadDevice.pluginProps['locationName']
+		self.Honeywell.arm_stay_instant(locationName)
+		self.updateDeviceStatus(dev)
+
+	def armAwayInstant(self, action, dev):
+		keypadDevice = dev
+		self.logger.info(u"Security panel %s away arming (instant).", keypadDevice.name)
+		locationName = keypadDevice.pluginProps['locationName']
+		self.Honeywell.arm_away_instant(locationName)
+		self.updateDeviceStatus(dev)
+
+	def armDisarmLocations(self, action):
+		armType, armModeName = BULK_ARM_MODES[action.props.get('armMode', 'disarm')]
+
+		# Group keypads by location, so each location receives a single command
+		keypadsByLocation = {}
+		for keypadId in action.props.get('keypads', []):
+			try:
+				keypad = indigo.devices[int(keypadId)]
+			except KeyError:
+				self.logger.warn(u"Keypad %s no longer exists; skipping it.", keypadId)
+				continue
+			keypadsByLocation.setdefault(keypad.pluginProps['locationName'], []).append(keypad)
+
+		if not keypadsByLocation:
+			self.logger.warn(u"No keypads selected for %s.", armModeName)
+			return
+
+		self.logger.info(u"Sending %s to %d location(s).", armModeName, len(keypadsByLocation))
+		results = self.Honeywell.execute_batch(dict((locationName, armType) for locationName in keypadsByLocation))
+
+		summary = []
+		for locationName in sorted(keypadsByLocation):
+			success, armedStatus = results[locationName]
+			summary.append(u"%s: %s" % (locationName, u"succeeded" if success else u"FAILED"))
+			if armedStatus is not None:
+				for keypad in keypadsByLocation[locationName]:
+					self.applyDeviceStatus(keypad, armedStatus)
+
+		if all(success for success, armedStatus in results.values()):
+			self.logger.info(u"%s results: %s", armModeName, u", ".join(summary))
+		else:
+			self.logger.warn(u"%s results: %s", armModeName, u", ".join(summary))
 		
 	def updateStatus(self, action, dev):	
 		keypadDevice = dev
 		self.updateDeviceStatus(keypadDevice)
 
+	########################################################
+	# Menu item callback methods
+	########################################################
+	def logStartupProfile(self):
+		self.logger.info('Total Connect start-up profile:')
+		for line in startupProfileReport(currentMemory=True):
+			self.logger.info(line)
+
 	########################################################
 	# Functions for configuration dialogs
 	########################################################
 
 	def getLocations(self, filter="", valuesDict=None, typeId="", targetId=0):
+		if not self.locationNames:
+			# The locations couldn't be loaded at start-up; try again
+			if self.Honeywell.get_locations() or self.Honeywell.populate_details():
+				self.loadLocationNames()
+
 		valuesList = []
 		for name in self.locationNames:
 			valuesList.append((name, name))
 		
 		return valuesList
+
+	def getHours(self, filter="", valuesDict=None, typeId="", targetId=0):
+		valuesList = []
+		for hour in range(24):
+			valuesList.append((str(hour), datetime.time(hour).strftime('%I:00 %p').lstrip('0')))
+
+		return valuesList
 		
 	def validateDeviceConfigUi(self, valuesDict, typeId, devId):
 		if typeId == 'alarmKeypad':
@@ -171,17 +336,35 @@ class Plugin(indigo.PluginBase):
 				errorDict["locationName"] = "You must associate this keypad with a location"
 				errorDict["showAlertText"] = "You must pick a location. If no locations are listed, log in to Total Connect to review your configuration."
 				return (False, valuesDict, errorDict)
+
+			if valuesDict.get('quietHoursEnabled', False) and (valuesDict['quietHoursStart'] == valuesDict['quietHoursEnd']):
+				errorDict = indigo.Dict()
+				errorDict["quietHoursEnd"] = "Quiet hours must end at a different time than they start"
+				return (False, valuesDict, errorDict)
 		
 		return True
+
+	def validateActionConfigUi(self, valuesDict, typeId, devId):
+		if typeId == 'actionArmDisarmLocations':
+			if not valuesDict.get('keypads'):
+				errorDict = indigo.Dict()
+				errorDict["keypads"] = "You must select at least one keypad"
+				return (False, valuesDict, errorDict)
+
+		return True
 		
 	def closedPrefsConfigUi(self, valuesDict, userCancelled):
 		if userCancelled == False:
 			if (valuesDict['username'] != self.tcUsername) or (valuesDict['password'] != self.tcPassword):
-				self.Honeywell.logout()
+				self.Honeywell.setCredentials(valuesDict['username'], valuesDict['password'])
+				# Reloaded from the new account when the keypad dialog next needs them
+				self.locationNames = []
 				
 			self.tcUsername = valuesDict['username']
 			self.tcPassword = valuesDict['password']
 		
 			self.refreshInterval = int(valuesDict['refreshInterval'])
+
+			setMemoryProfiling(valuesDict.get('profileMemory', False))
 		
 	
\ No newline at end of file